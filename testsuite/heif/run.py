@@ -4,6 +4,9 @@
 # SPDX-License-Identifier: Apache-2.0
 # https://github.com/AcademySoftwareFoundation/OpenImageIO
 
+# Every sub-command only reads its own input, so they may run concurrently.
+parallel = 1
+
 imagedir = "ref/"
 files = [ "IMG_7702_small.heic", "Chimera-AV1-8bit-162.avif" ]
 for f in files:
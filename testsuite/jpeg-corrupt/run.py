@@ -7,6 +7,8 @@
 
 failureok = 1
 redirect = ' >> out.txt 2>&1 '
+# Every sub-command only reads its own input, so they may run concurrently.
+parallel = 1
 
 # This file has a corrupted Exif block in the metadata. It used to
 # crash on some platforms, on others would be caught by address sanitizer.
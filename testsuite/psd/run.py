@@ -5,6 +5,8 @@
 # https://github.com/AcademySoftwareFoundation/OpenImageIO
 
 redirect = ' >> out.txt 2>&1 '
+# Every sub-command only reads its own input, so they may run concurrently.
+parallel = 1
 
 files = [ "psd_123.psd", "psd_123_nomaxcompat.psd", "psd_bitmap.psd",
           "psd_indexed_trans.psd", "psd_rgb_8.psd", "psd_rgb_16.psd",
@@ -5,13 +5,25 @@
 # https://github.com/AcademySoftwareFoundation/OpenImageIO
 
 import os
-import glob
 import sys
 import platform
+import json
+import re
+import shlex
 import subprocess
 import difflib
+import itertools
+import marshal
 import filecmp
+import fnmatch
+import functools
+import hashlib
+import importlib.util
 import shutil
+import stat
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from optparse import OptionParser
 
@@ -47,11 +59,15 @@ tmpdir = "."
 tmpdir = os.path.abspath (tmpdir)
 redirect = " >> out.txt "
 wrapper_cmd = ""
+is_windows = (platform.system() == 'Windows')
 
+# N.B. The results are cached, which is safe because the working directory
+# never changes once we have moved into the test directory above.
+@functools.lru_cache (maxsize=4096)
 def make_relpath (path, start=os.curdir):
     "Wrapper around os.path.relpath which always uses '/' as the separator."
     p = os.path.relpath (path, start)
-    return p if platform.system() != 'Windows' else p.replace ('\\', '/')
+    return p if not is_windows else p.replace ('\\', '/')
 
 # Try to figure out where some key things are. Go by env variables set by
 # the cmake tests, but if those aren't set, assume somebody is running
@@ -82,21 +98,76 @@ if str(mytest).endswith('.batch') :
 test_source_dir = os.getenv('OIIO_TESTSUITE_SRC',
                             os.path.join(OIIO_TESTSUITE_ROOT, mytest))
 
-def oiio_app (app):
-    if (platform.system () != 'Windows' or options.devenv_config == ""):
-        cmd = os.path.join(OIIO_BUILD_ROOT, "bin", app) + " "
+# The location of each app never changes during a run, so only work it
+# out once per app. (The wrapper is applied separately by oiio_app, since
+# run.py may set wrapper_cmd.)
+@functools.lru_cache (maxsize=None)
+def oiio_app_path (app):
+    if (not is_windows or options.devenv_config == ""):
+        return os.path.join(OIIO_BUILD_ROOT, "bin", app)
     else:
-        cmd = os.path.join(OIIO_BUILD_ROOT, "bin", options.devenv_config, app) + " "
+        return os.path.join(OIIO_BUILD_ROOT, "bin", options.devenv_config, app)
+
+def oiio_app (app):
+    cmd = oiio_app_path(app) + " "
     if wrapper_cmd != "":
         cmd = wrapper_cmd + " " + cmd
     return cmd
 
 
-# Ask oiiotool what version of OpenColorIO it has embedded
-ociover = subprocess.check_output([oiio_app('oiiotool').strip(),
-                                   '--echo', '{getattribute(opencolorio_version)}'])
-ociover = ociover.strip().decode('utf-8')[0:3]
-ociover = os.getenv('OCIO_VERSION_OVERRIDE', ociover)
+# Return the paths of the OpenImageIO libraries in the build area.
+def oiio_lib_files () :
+    libs = []
+    for d in ("lib", "lib64", "bin") :
+        d = os.path.join(OIIO_BUILD_ROOT, d)
+        if os.path.isdir (d) :
+            with os.scandir (d) as entries :
+                libs += [ e.path for e in entries
+                          if e.name.startswith(("libOpenImageIO", "OpenImageIO"))
+                             and e.is_file() ]
+    return sorted (libs)
+
+
+# Ask oiiotool what version of OpenColorIO it has embedded. Starting up
+# oiiotool just for that is expensive when repeated for every test, so the
+# answer is remembered in the build area, keyed by the modification times
+# of the oiiotool binary and the OpenImageIO libraries (which may be
+# rebuilt against a different OCIO without relinking oiiotool).
+def get_ociover () :
+    ociover = os.getenv('OCIO_VERSION_OVERRIDE')
+    if ociover is not None :
+        return ociover
+    oiiotool_path = oiio_app('oiiotool').strip()
+    cache_file = os.path.join(OIIO_BUILD_ROOT, '.ociover_cache')
+    try :
+        mtime = " ".join([ str(os.stat(f).st_mtime_ns)
+                           for f in [oiiotool_path] + oiio_lib_files() ])
+    except OSError :
+        mtime = None
+    if mtime :
+        try :
+            with open(cache_file, 'r') as f :
+                ociover = json.load(f).get(mtime)
+            if ociover :
+                return ociover
+        except (OSError, ValueError, AttributeError) :
+            pass
+    ociover = subprocess.check_output([oiiotool_path,
+                                       '--echo', '{getattribute(opencolorio_version)}'])
+    ociover = ociover.strip().decode('utf-8')[0:3]
+    if mtime :
+        # Write to a private file and rename, so that tests running
+        # concurrently never see a partially written cache.
+        tmp_file = cache_file + '.' + str(os.getpid())
+        try :
+            with open(tmp_file, 'w') as f :
+                json.dump({ mtime : ociover }, f)
+            os.replace(tmp_file, cache_file)
+        except OSError :
+            pass
+    return ociover
+
+ociover = get_ociover()
 #print(f"OpenColorIO version = '{ociover}'")
 
 OCIO_env = os.getenv('OCIO')
@@ -130,15 +201,24 @@ allowfailures = 0          # Freebie failures
 # or fail based on comparing the output files.
 failureok = 0
 
+# Tests whose sub-commands are all independent of one another (none reads a
+# file that another one writes) may set `parallel = 1` to run them
+# concurrently. Their output to out.txt is still assembled in the order the
+# commands appear. The commands run serially anyway if any of them uses
+# out.txt other than by simply appending its output to it (see
+# parallel_safe), or if the environment variable OIIO_TESTSUITE_SERIAL=1.
+parallel = 0
+
 
 anymatch = False
 cleanup_on_success = False
 if int(os.getenv('TESTSUITE_CLEANUP_ON_SUCCESS', '0')) :
     cleanup_on_success = True
 
-image_extensions = [ ".tif", ".tx", ".exr", ".jpg", ".png", ".rla",
-                     ".dpx", ".iff", ".psd", ".bmp", ".fits", ".ico",
-                     ".jp2", ".jxl", ".sgi", ".tga", ".TGA", ".zfile" ]
+# Extensions (in lower case) of outputs to compare as images
+image_extensions = frozenset ({ ".tif", ".tiff", ".tx", ".exr", ".jpg", ".png",
+                                ".rla", ".dpx", ".iff", ".psd", ".bmp", ".fits",
+                                ".ico", ".jp2", ".jxl", ".sgi", ".tga", ".zfile" })
 
 # print ("srcdir = " + srcdir)
 # print ("tmpdir = " + tmpdir)
@@ -147,11 +227,31 @@ image_extensions = [ ".tif", ".tx", ".exr", ".jpg", ".png", ".rla",
 # print ("refdir = " + refdir)
 # print ("test source dir = " + test_source_dir)
 
-if platform.system() == 'Windows' :
-    if not os.path.exists("./ref") :
-        shutil.copytree (os.path.join (test_source_dir, "ref"), "./ref")
-    if os.path.exists (os.path.join (test_source_dir, "src")) and not os.path.exists("./src") :
-        shutil.copytree (os.path.join (test_source_dir, "src"), "./src")
+# Find out which of ref, src, and data are already set up with a single
+# scan of the test directory, rather than checking for each one. As with
+# os.path.exists, a broken symlink doesn't count.
+with os.scandir (".") as entries :
+    present = { e.name for e in entries
+                if e.name in ("ref", "src", "data")
+                   and (not e.is_symlink() or os.path.exists(e.path)) }
+need_src = ("src" not in present
+            and os.path.exists (os.path.join (test_source_dir, "src")))
+
+if is_windows :
+    # Hard link the files rather than copying them, where the filesystem
+    # allows it. (Just as with the symlinks we make elsewhere, tests must
+    # not modify anything in ref or src.)
+    def link_or_copy (src, dst):
+        try:
+            os.link (src, dst)
+        except OSError:
+            shutil.copy2 (src, dst)
+    if "ref" not in present :
+        shutil.copytree (os.path.join (test_source_dir, "ref"), "./ref",
+                         copy_function=link_or_copy)
+    if need_src :
+        shutil.copytree (os.path.join (test_source_dir, "src"), "./src",
+                         copy_function=link_or_copy)
     # if not os.path.exists("../data") :
     #     shutil.copytree ("../../testsuite/data", "..")
     # if not os.path.exists("../common") :
@@ -163,11 +263,11 @@ else :
         if os.path.islink(dst):
             os.remove(dst)
         os.symlink (src, dst)
-    if not os.path.exists("./ref") :
+    if "ref" not in present :
         newsymlink (os.path.join (test_source_dir, "ref"), "./ref")
-    if os.path.exists (os.path.join (test_source_dir, "src")) and not os.path.exists("./src") :
+    if need_src :
         newsymlink (os.path.join (test_source_dir, "src"), "./src")
-    if not os.path.exists("./data") :
+    if "data" not in present :
         newsymlink (test_source_dir, "./data")
 
 
@@ -189,12 +289,39 @@ else :
 # Based on the command-line interface to difflib example from the Python
 # documentation
 def text_diff (fromfile, tofile, diff_file=None):
-    import time
+    # Usually the files are identical, and a byte comparison (which
+    # immediately rejects files of different sizes) is much cheaper than
+    # building a diff.
+    try:
+        if filecmp.cmp (fromfile, tofile, shallow=False) :
+            return 0
+    except OSError:
+        pass   # reported below
+    # difflib is pure Python and very slow on large files with nontrivial
+    # differences, so for those use the system diff if there is one. If it
+    # can't do the job (exit status 2), fall back to difflib.
+    try:
+        bigfile = max (os.path.getsize (fromfile),
+                       os.path.getsize (tofile)) > 256*1024
+    except OSError:
+        bigfile = False
+    if bigfile and shutil.which ('diff') :
+        with open (diff_file or os.devnull, 'wb') as f:
+            diffret = subprocess.call (['diff', '-u', '-a', '--strip-trailing-cr',
+                                        fromfile, tofile], stdout=f)
+        if diffret == 0 :
+            return 0
+        if diffret == 1 :
+            if diff_file:
+                print_diff (fromfile, tofile, diff_file)
+            return 1
     try:
         fromdate = time.ctime (os.stat (fromfile).st_mtime)
         todate = time.ctime (os.stat (tofile).st_mtime)
-        fromlines = open (fromfile, 'r').readlines()
-        tolines   = open (tofile, 'r').readlines()
+        with open (fromfile, 'r', encoding='utf-8', errors='replace') as f:
+            fromlines = f.read().splitlines(keepends=True)
+        with open (tofile, 'r', encoding='utf-8', errors='replace') as f:
+            tolines = f.read().splitlines(keepends=True)
         # if replace_relative:
         #     tolines = replace_relative(tolines)
     except:
@@ -203,23 +330,30 @@ def text_diff (fromfile, tofile, diff_file=None):
         
     diff = difflib.unified_diff(fromlines, tolines, fromfile, tofile,
                                 fromdate, todate)
-    # Diff is a generator, but since we need a way to tell if it is
-    # empty we just store all the text in advance
-    diff_lines = [l for l in diff]
-    if not diff_lines:
+    # Diff is a generator. Peek at the first line to tell if it is empty,
+    # then stream the whole thing to the diff file rather than holding it
+    # all in memory.
+    first = next (diff, None)
+    if first is None:
         return 0
     if diff_file:
         try:
-            open (diff_file, 'w').writelines (diff_lines)
-
-            print ("Diff " + fromfile + " vs " + tofile + " was:\n-------")
-#            print (diff)
-            print ("".join(diff_lines))
+            with open (diff_file, 'w') as f:
+                f.writelines (itertools.chain ([first], diff))
+            print_diff (fromfile, tofile, diff_file)
         except:
             print ("Unexpected error:", sys.exc_info()[0])
     return 1
 
 
+# Echo the diff that text_diff wrote to diff_file.
+def print_diff (fromfile, tofile, diff_file):
+    print ("Diff " + fromfile + " vs " + tofile + " was:\n-------")
+    with open (diff_file, 'r') as f:
+        shutil.copyfileobj (f, sys.stdout)
+    print ()
+
+
 def run_app(app, silent=False, concat=True):
     command = app
     if not silent:
@@ -229,23 +363,136 @@ def run_app(app, silent=False, concat=True):
     return command
 
 
+# Any of these characters means a sub-command needs a real shell to run it.
+shell_syntax_re = re.compile (r'[|&;<>()$`*?\[\]{}~#!\\\n]')
+shell_builtins = { 'cd', 'export', 'set', 'unset', 'source', '.', 'exec',
+                   'eval', 'exit', 'ulimit', 'umask', 'alias', 'trap' }
+
+# Run one sub-command and return its exit status. Simple commands -- no
+# pipes, redirection, variables, globs, or builtins -- are split into their
+# arguments and executed directly, so we don't pay for launching a shell
+# just to have it launch the program. Anything else goes through the shell.
+def run_subcommand (sub, env=None, stdout=None, stderr=None) :
+    if not is_windows and not shell_syntax_re.search(sub) :
+        try :
+            args = shlex.split (sub)
+        except ValueError :
+            args = []   # e.g., unbalanced quotes; let the shell report it
+        if args and '=' not in args[0] and args[0] not in shell_builtins :
+            try :
+                return subprocess.call (args, env=env, stdout=stdout, stderr=stderr)
+            except OSError :
+                pass   # e.g., not found; let the shell report it
+    return subprocess.call (sub, shell=True, env=env, stdout=stdout, stderr=stderr)
+
+
+# Match the trailing redirection of a sub-command's output to out.txt (and
+# optionally its stderr, and a "|| true" to ignore its exit status), so that
+# the runner can set up the redirection itself.
+out_redirect_re = re.compile (r'(?P<space>\s*)>>\s*out\.txt(?P<stderr>\s+2>&1)?'
+                              r'(?P<ignorefail>\s*\|\|\s*true)?\s*$')
+
+# If a sub-command ends by appending its output to out.txt, return a tuple
+# of the command without that redirection, whether stderr should go there
+# too, and whether its exit status should be ignored. Otherwise, or if the
+# redirection applies to only the last part of a compound command (as in
+# `a && b >> out.txt`), or if the command has other redirections whose
+# order relative to it matters (as in `a 2>&1 >> out.txt`), return None.
+def split_out_redirect (sub) :
+    m = out_redirect_re.search (sub)
+    if not m :
+        return None
+    cmd = sub[:m.start()]
+    if not m.group('space') and re.search (r'(^|\s)\d+$|&$', cmd) :
+        return None   # e.g. `2>> out.txt` or `&>> out.txt`, not stdout
+    if re.search (r'&&|\|\||&\s*$|[<>]', cmd) :
+        return None
+    return (cmd, bool(m.group('stderr')), bool(m.group('ignorefail')))
+
+# Run one sub-command and return its exit status. If it ends by appending
+# its output to out.txt, hand the child the already open `outfile` instead,
+# which spares reopening out.txt for every command and usually lets
+# run_subcommand skip the shell altogether.
+def run_redirected (sub, outfile, env=None) :
+    split = split_out_redirect (sub)
+    if not split :
+        return run_subcommand (sub, env=env)
+    (cmd, with_stderr, ignorefail) = split
+    ret = run_subcommand (cmd, env=env, stdout=outfile,
+                          stderr=(subprocess.STDOUT if with_stderr else None))
+    return 0 if ignorefail else ret
+
+
+# Run a single command line built by one of the helpers above, handling its
+# redirection to out.txt the same way as for the test's own commands.
+def run_command (cmd) :
+    with open ("out.txt", "ab", buffering=0) as outfile :
+        return run_redirected (cmd.strip(), outfile)
+
+
+# Print a listing of files akin to `ls -al`, without running ls.
+def ls_al (filenames) :
+    for f in filenames :
+        try :
+            st = os.stat (f)
+        except OSError :
+            print ("ls: cannot access " + f)
+            continue
+        print ("%s %d %10d %s %s" % (stat.filemode(st.st_mode), st.st_nlink,
+                                     st.st_size, time.ctime(st.st_mtime), f))
+
+
+# Can the sub-commands run concurrently and still leave out.txt in command
+# order? Only if the one way any of them touches out.txt is the trailing
+# redirection that run_redirected takes over.
+def parallel_safe (subcommands) :
+    for sub in subcommands :
+        split = split_out_redirect (sub)
+        if 'out.txt' in (split[0] if split else sub) :
+            return False
+    return True
+
+# Run a list of independent shell sub-commands concurrently, using up to one
+# process per core. Output that a sub-command would have appended to out.txt
+# goes to its own temporary file instead, and those are appended to
+# `outfile` in the original command order once everything has finished.
+# Return the list of exit codes, also in command order. The caller must
+# check parallel_safe() first.
+def run_parallel (subcommands, outfile, env=None) :
+    def run_one (sub) :
+        tmp = tempfile.TemporaryFile (dir=tmpdir)
+        try :
+            return (run_redirected (sub, tmp, env=env), tmp)
+        except :
+            tmp.close ()
+            raise
+
+    with ThreadPoolExecutor (max_workers=(os.cpu_count() or 1)) as pool :
+        results = list (pool.map (run_one, subcommands))
+    for (ret, tmp) in results :
+        tmp.seek (0)
+        shutil.copyfileobj (tmp, outfile)
+        tmp.close ()
+    return [ret for (ret, tmp) in results]
+
+
 # Construct a command that will print info for an image, appending output to
 # the file "out.txt".  If 'safematch' is nonzero, it will exclude printing
 # of fields that tend to change from run to run or release to release.
 def info_command (file, extraargs="", safematch=False, hash=True,
                   verbose=True, silent=False, concat=True, failureok=False,
                   info_program="oiiotool") :
-    args = ""
+    args = [ oiio_app(info_program) ]
     if info_program == "oiiotool" :
-        args += " --info"
+        args.append ("--info")
     if verbose :
-        args += " -v -a"
+        args.append ("-v -a")
     if safematch :
-        args += " --no-metamatch \"DateTime|Software|OriginatingProgram|ImageHistory\""
+        args.append ("--no-metamatch \"DateTime|Software|OriginatingProgram|ImageHistory\"")
     if hash :
-        args += " --hash"
-    cmd = (oiio_app(info_program) + args + " " + extraargs
-            + " " + make_relpath(file,tmpdir))
+        args.append ("--hash")
+    args += [ extraargs, make_relpath(file,tmpdir) ]
+    cmd = " ".join (args)
     if not silent :
         cmd += redirect
     if failureok :
@@ -260,15 +507,15 @@ def info_command (file, extraargs="", safematch=False, hash=True,
 # 1 LSB (8 bit) error, it's very hard to make different platforms and
 # compilers always match to every last floating point bit.
 def diff_command (fileA, fileB, extraargs="", silent=False, concat=True) :
-    command = (oiio_app("idiff") + "-a"
-               + " -fail " + str(failthresh)
-               + " -failpercent " + str(failpercent)
-               + " -hardfail " + str(hardfail)
-               + " -allowfailures " + str(allowfailures)
-               + " -warn " + str(2*failthresh)
-               + " -warnpercent " + str(failpercent)
-               + " " + extraargs + " " + make_relpath(fileA,tmpdir)
-               + " " + make_relpath(fileB,tmpdir))
+    command = " ".join ([oiio_app("idiff") + "-a",
+                         "-fail", str(failthresh),
+                         "-failpercent", str(failpercent),
+                         "-hardfail", str(hardfail),
+                         "-allowfailures", str(allowfailures),
+                         "-warn", str(2*failthresh),
+                         "-warnpercent", str(failpercent),
+                         extraargs, make_relpath(fileA,tmpdir),
+                         make_relpath(fileB,tmpdir)])
     if not silent :
         command += redirect
     if concat:
@@ -276,15 +523,84 @@ def diff_command (fileA, fileB, extraargs="", silent=False, concat=True) :
     return command
 
 
+# Import the OpenImageIO Python module from the build area's
+# lib*/python*/site-packages, and return it, or None if there isn't one.
+# It must be the build under test, never some other copy that happens to be
+# installed, so the module is only accepted if it was loaded from there.
+def import_build_oiio () :
+    build_root = os.path.realpath (OIIO_BUILD_ROOT)
+    pydirs = []
+    for lib in ("lib", "lib64") :
+        libdir = os.path.join (build_root, lib)
+        if os.path.isdir (libdir) :
+            with os.scandir (libdir) as entries :
+                pydirs += [ os.path.join (e.path, "site-packages") for e in entries
+                            if e.name.startswith ("python") and e.is_dir() ]
+    pydirs = [ d for d in pydirs if os.path.isdir (d) ]
+    if not pydirs :
+        return None
+    saved_path = sys.path
+    sys.path = pydirs + sys.path
+    try :
+        import OpenImageIO
+    except ImportError :
+        return None
+    finally :
+        sys.path = saved_path
+    if not os.path.realpath (OpenImageIO.__file__).startswith (build_root + os.sep) :
+        return None
+    return OpenImageIO
+
+
+# Compare two images in-process using the OpenImageIO Python bindings,
+# applying the same ImageBufAlgo.compare test and thresholds that
+# diff_command() passes to idiff, which spares launching idiff for each
+# comparison. Return 0 if the images match and 1 if they don't, like idiff's
+# exit status, or None if the comparison should be left to idiff instead:
+# the build area has no Python bindings (or OIIO_TESTSUITE_PYIDIFF=0), an
+# image can't be read, or the files have multiple subimages or MIP levels or deep
+# data, which need idiff's more elaborate handling.
+def py_idiff (fileA, fileB) :
+    global py_oiio
+    if py_oiio is None :
+        py_oiio = False
+        if int(os.getenv('OIIO_TESTSUITE_PYIDIFF', '1')) :
+            py_oiio = import_build_oiio () or False
+    if not py_oiio :
+        return None
+    oiio = py_oiio
+    A = oiio.ImageBuf (fileA)
+    B = oiio.ImageBuf (fileB)
+    if (not A.read (0, 0, True, oiio.FLOAT) or not B.read (0, 0, True, oiio.FLOAT)
+            or A.nsubimages > 1 or B.nsubimages > 1
+            or A.nmiplevels > 1 or B.nmiplevels > 1 or A.deep or B.deep) :
+        A.geterror ()   # Clear any errors; idiff will report them
+        B.geterror ()
+        return None
+    cr = oiio.ImageBufAlgo.compare (A, B, failthresh, 2*failthresh)
+    if A.has_error or B.has_error :
+        A.geterror ()
+        B.geterror ()
+        return None
+    spec = A.spec()
+    npels = max (spec.width * spec.height * spec.depth, 1)
+    if cr.nfail <= allowfailures :
+        return 0
+    if (cr.nfail > failpercent / 100.0 * npels or cr.maxerror > hardfail
+            or cr.nwarn > failpercent / 100.0 * npels) :
+        return 1
+    return 0
+
+py_oiio = None
+
+
 # Construct a command that will create a texture, appending console
 # output to the file "out.txt".
 def maketx_command (infile, outfile, extraargs="",
                     showinfo=False, showinfo_extra="",
                     silent=False, concat=True) :
-    command = (oiio_app("maketx")
-               + " " + make_relpath(infile,tmpdir)
-               + " " + extraargs
-               + " -o " + make_relpath(outfile,tmpdir))
+    command = " ".join ([oiio_app("maketx"), make_relpath(infile,tmpdir),
+                         extraargs, "-o", make_relpath(outfile,tmpdir)])
     if not silent :
         command += redirect
     if concat:
@@ -313,18 +629,19 @@ def rw_command (dir, filename, testwrite=True, use_oiiotool=False, extraargs="",
         output_filename = filename
     if testwrite :
         if use_oiiotool :
-            cmd = (cmd + oiio_app("oiiotool") + preargs + " " + fn
-                   + " " + extraargs + " -o " + output_filename + redirect + ";\n")
+            args = [ oiio_app("oiiotool") + preargs, fn, extraargs,
+                     "-o", output_filename ]
         else :
-            cmd = (cmd + oiio_app("iconvert") + preargs + " " + fn
-                   + " " + extraargs + " " + output_filename + redirect + ";\n")
-        cmd = (cmd + oiio_app("idiff") + " -a " + fn
-               + " -fail " + str(failthresh)
-               + " -failpercent " + str(failpercent)
-               + " -hardfail " + str(hardfail)
-               + " -allowfailures " + str(allowfailures)
-               + " -warn " + str(2*failthresh)
-               + " " + idiffextraargs + " " + output_filename + redirect + ";\n")
+            args = [ oiio_app("iconvert") + preargs, fn, extraargs,
+                     output_filename ]
+        cmd += " ".join (args) + redirect + ";\n"
+        cmd += " ".join ([oiio_app("idiff"), "-a", fn,
+                          "-fail", str(failthresh),
+                          "-failpercent", str(failpercent),
+                          "-hardfail", str(hardfail),
+                          "-allowfailures", str(allowfailures),
+                          "-warn", str(2*failthresh),
+                          idiffextraargs, output_filename]) + redirect + ";\n"
     return cmd
 
 
@@ -365,6 +682,50 @@ def oiiotool (args, silent=False, concat=True, failureok=False) :
 
 
 
+# Return a SHA-1 digest of the contents of a file.
+def file_digest (filename) :
+    with open (filename, 'rb') as f :
+        if hasattr (hashlib, 'file_digest') :   # Python 3.11+
+            return hashlib.file_digest (f, 'sha1').digest()
+        h = hashlib.sha1 ()
+        for block in iter (lambda: f.read (1 << 20), b'') :
+            h.update (block)
+        return h.digest()
+
+
+
+# Return True if two files have identical contents. Files of different
+# sizes are rejected without reading either one.
+def files_identical (fileA, fileB) :
+    if os.path.getsize (fileA) != os.path.getsize (fileB) :
+        return False
+    return filecmp.cmp (fileA, fileB, shallow=False)
+
+
+
+# Directory listings of the reference directories, read on first use.
+ref_listings = {}
+
+# Equivalent to glob.glob(os.path.join(dir, pattern)), for a pattern with
+# wildcards only in its last component, except that each directory is only
+# read once however many outputs are checked against it.
+def ref_glob (dir, pattern) :
+    (subdir, pattern) = os.path.split (pattern)
+    dir = os.path.join (dir, subdir)
+    if dir not in ref_listings :
+        try :
+            with os.scandir (dir) as entries :
+                ref_listings[dir] = [ e.name for e in entries ]
+        except OSError :
+            ref_listings[dir] = []
+    names = ref_listings[dir]
+    if not pattern.startswith ('.') :
+        # Like glob, wildcards don't match hidden files
+        names = [ n for n in names if not n.startswith ('.') ]
+    return [ os.path.join (dir, n) for n in fnmatch.filter (names, pattern) ]
+
+
+
 # Check one output file against reference images in a list of reference
 # directories. For each directory, it will first check for a match under
 # the identical name, and if that fails, it will look for alternatives of
@@ -374,6 +735,7 @@ def checkref (name, refdirlist) :
     # Break the output into prefix+extension
     (prefix, extension) = os.path.splitext(name)
     ok = 0
+    name_digest = None
     for ref in refdirlist :
         # We will first compare name to ref/name, and if that fails, we will
         # compare it to everything else that matches ref/prefix-*.extension.
@@ -384,21 +746,34 @@ def checkref (name, refdirlist) :
             pattern = "*.*"
         else :
             pattern = prefix+"-*"+extension+"*"
-        print("comparisons are", ([defaulttest] + glob.glob (os.path.join (ref, pattern))))
-        for testfile in ([defaulttest] + glob.glob (os.path.join (ref, pattern))) :
+        comparisons = [defaulttest] + ref_glob (ref, pattern)
+        print("comparisons are", comparisons)
+        for testfile in comparisons :
             if not os.path.exists(testfile) :
                 continue
             print ("comparing " + name + " to " + testfile)
-            if extension in image_extensions :
-                # images -- use idiff
-                cmpcommand = diff_command (name, testfile, concat=False, silent=True)
-                cmpresult = os.system (cmpcommand)
+            if extension.lower() in image_extensions :
+                # images -- a byte-for-byte identical file surely matches,
+                # and checking that is far cheaper than a pixel comparison.
+                # Otherwise, compare in-process if we can, else use idiff.
+                cmpresult = None
+                if (os.path.isfile(name)
+                        and os.path.getsize(name) == os.path.getsize(testfile)) :
+                    if name_digest is None :
+                        name_digest = file_digest (name)
+                    if file_digest (testfile) == name_digest :
+                        cmpresult = 0
+                if cmpresult is None :
+                    cmpresult = py_idiff (name, testfile)
+                if cmpresult is None :
+                    cmpcommand = diff_command (name, testfile, concat=False, silent=True)
+                    cmpresult = run_subcommand (cmpcommand)
             elif extension == ".txt" :
                 cmpresult = text_diff (name, testfile, name + ".diff")
             else :
                 # anything else
                 cmpresult = 0
-                if os.path.exists(testfile) and filecmp.cmp (name, testfile) :
+                if os.path.exists(testfile) and files_identical (name, testfile) :
                     cmpresult = 0
                 else :
                     cmpresult = 1
@@ -412,7 +787,7 @@ def checkref (name, refdirlist) :
 # in 'ref/'.  If all outputs match their reference copies, return 0
 # to pass.  If any outputs do not match their references return 1 to
 # fail.
-def runtest (command, outputs, failureok=0) :
+def runtest (command, outputs, failureok=0, parallel=0) :
     err = 0
 #    print ("working dir = " + tmpdir)
     os.chdir (srcdir)
@@ -426,7 +801,7 @@ def runtest (command, outputs, failureok=0) :
     print ("command = " + command)
 
     test_environ = None
-    if (platform.system () == 'Windows') and (options.solution_path != "") and \
+    if is_windows and (options.solution_path != "") and \
        (os.path.isdir (options.solution_path)):
         test_environ = os.environ
         libOIIO_args = [options.solution_path, "libOpenImageIO"]
@@ -435,30 +810,37 @@ def runtest (command, outputs, failureok=0) :
         libOIIO_path = os.path.normpath (os.path.join (*libOIIO_args))
         test_environ["PATH"] = libOIIO_path + ';' + test_environ["PATH"]
 
-    for sub_command in [c.strip() for c in command.split(';') if c.strip()]:
-        cmdret = subprocess.call (sub_command, shell=True, env=test_environ)
-        if cmdret != 0 and failureok == 0 :
-            print ("#### Error: this command failed: ", sub_command)
-            print ("FAIL")
-            err = 1
+    subcommands = [c.strip() for c in command.split(';') if c.strip()]
+    with open ("out.txt", "ab", buffering=0) as outfile :
+        if (parallel and not int(os.getenv('OIIO_TESTSUITE_SERIAL', '0'))
+                and parallel_safe (subcommands)) :
+            cmdrets = run_parallel (subcommands, outfile, env=test_environ)
+        else :
+            cmdrets = (run_redirected (sub_command, outfile, env=test_environ)
+                       for sub_command in subcommands)
+        for (sub_command, cmdret) in zip (subcommands, cmdrets) :
+            if cmdret != 0 and failureok == 0 :
+                print ("#### Error: this command failed: ", sub_command)
+                print ("FAIL")
+                err = 1
 
     for out in outputs :
         (prefix, extension) = os.path.splitext(out)
         # On Windows, change line endings of text files to unix style before
         # comparison to reference output.
-        if (platform.system() == 'Windows' and os.path.exists(out)
+        if (is_windows and os.path.exists(out)
                 and extension == '.txt') :
-            os.rename (out, "crlf.txt")
-            os.system ("tr -d '\\r' < crlf.txt > " + out)
-            if os.path.exists('crlf.txt') :
-                os.remove('crlf.txt')
+            with open (out, 'rb') as f :
+                text = f.read ()
+            with open (out, 'wb') as f :
+                f.write (text.translate (None, b'\r'))
 
         (ok, testfile) = checkref (out, refdirlist)
 
         if ok :
-            if extension in image_extensions :
+            if extension.lower() in image_extensions :
                 # If we got a match for an image, save the idiff results
-                os.system (diff_command (out, testfile, silent=False, concat=False))
+                run_command (diff_command (out, testfile, silent=False, concat=False))
             print ("PASS: " + out + " matches " + testfile)
         else :
             err = 1
@@ -468,16 +850,19 @@ def runtest (command, outputs, failureok=0) :
                 # If we failed to get a match for a text file, print the
                 # file and the diff, for easy debugging.
                 print ("-----" + out + "----->")
-                print (open(out,'r').read() + "<----------")
+                with open (out, 'r') as f :
+                    print (f.read() + "<----------")
                 print ("-----" + testfile + "----->")
-                print (open(testfile,'r').read() + "<----------")
-                os.system ("ls -al " +out+" "+testfile)
+                with open (testfile, 'r') as f :
+                    print (f.read() + "<----------")
+                ls_al ([out, testfile])
                 print ("Diff was:\n-------")
-                print (open (out+".diff", 'r').read())
-            if extension in image_extensions :
+                with open (out+".diff", 'r') as f :
+                    print (f.read())
+            if extension.lower() in image_extensions :
                 # If we failed to get a match for an image, send the idiff
                 # results to the console
-                os.system (diff_command (out, testfile, silent=False, concat=False))
+                run_command (diff_command (out, testfile, silent=False, concat=False))
             if os.path.isfile("debug.log") and os.path.getsize("debug.log") :
                 print ("---   DEBUG LOG   ---\n")
                 #flog = open("debug.log", "r")
@@ -492,13 +877,89 @@ def runtest (command, outputs, failureok=0) :
 
 
 
+# Environment variables that can change a test's result.
+fingerprint_env = [ "OCIO", "OIIO_TESTSUITE_OCIOCONFIG", "OCIO_VERSION_OVERRIDE",
+                    "PATH", "PYTHONPATH", "LD_LIBRARY_PATH", "DYLD_LIBRARY_PATH",
+                    "Python_EXECUTABLE", "PYTHON_VERSION", "CI", "DEBUG" ]
+
+# Return a digest of the paths, modification times, and sizes of all the
+# files under directory `d`.
+def dir_fingerprint (d) :
+    h = hashlib.blake2b (digest_size=16)
+    for (dirpath, dirnames, filenames) in os.walk (d, followlinks=True) :
+        dirnames.sort ()
+        for f in sorted (filenames) :
+            f = os.path.join (dirpath, f)
+            try :
+                st = os.stat (f)
+                h.update (("%s %d %d\n" % (f, st.st_mtime_ns, st.st_size)).encode())
+            except OSError :
+                h.update (("%s missing\n" % f).encode())
+    return h.hexdigest()
+
+# Compute a fingerprint of everything a test's result depends on: the
+# commands and settings from run.py, the relevant environment variables,
+# this script, and every file in the test's source directory (which is
+# also what the "data" symlink points to), the reference directories, the
+# build area's bin, lib, and include directories (apps, libraries, plugins,
+# the Python module, and headers), the shared testsuite "common"
+# directory, and the test image directory. Directories reached by more
+# than one path are only walked once. Used by OIIO_TESTSUITE_INCREMENTAL.
+def test_fingerprint (command, outputs) :
+    h = hashlib.blake2b (digest_size=16)
+    h.update (repr ((command, outputs, failthresh, failpercent, hardfail,
+                     allowfailures, failureok, anymatch, refdirlist,
+                     [ (v, os.getenv(v)) for v in fingerprint_env ])).encode())
+    st = os.stat (__file__)
+    h.update (("%d %d\n" % (st.st_mtime_ns, st.st_size)).encode())
+    dirs = [ test_source_dir,
+             os.path.join(OIIO_BUILD_ROOT, "bin"),
+             os.path.join(OIIO_BUILD_ROOT, "lib"),
+             os.path.join(OIIO_BUILD_ROOT, "lib64"),
+             os.path.join(OIIO_BUILD_ROOT, "include"),
+             os.path.join(OIIO_TESTSUITE_ROOT, "common"),
+             "../common" ] + refdirlist
+    if OIIO_TESTSUITE_IMAGEDIR != "" :
+        dirs.append (OIIO_TESTSUITE_IMAGEDIR)
+    for d in sorted (set (os.path.realpath (d) for d in dirs if os.path.isdir (d))) :
+        h.update (("%s %s\n" % (d, dir_fingerprint (d))).encode())
+    return h.hexdigest()
+
+testcache_file = os.path.join (srcdir, ".testcache.json")
+
+
+# Compile a test's run.py. The code object is cached in the test's
+# directory in the build area, keyed by the Python version and the path,
+# modification time, and size of the source, so that rerunning the same
+# test doesn't have to recompile it.
+def compile_run_py (filename, cachefile="run.pyc") :
+    st = os.stat (filename)
+    key = (importlib.util.MAGIC_NUMBER, os.path.abspath(filename),
+           st.st_mtime_ns, st.st_size)
+    try :
+        with open (cachefile, 'rb') as f :
+            (cachedkey, code) = marshal.load (f)
+        if cachedkey == key :
+            return code
+    except (OSError, EOFError, ValueError, TypeError) :
+        pass
+    with open (filename) as f :
+        code = compile (f.read(), "run.py", 'exec')
+    try :
+        tmpfile = cachefile + '.' + str(os.getpid())
+        with open (tmpfile, 'wb') as f :
+            marshal.dump ((key, code), f)
+        os.replace (tmpfile, cachefile)
+    except OSError :
+        pass
+    return code
+
+
 #
 # Read the individual run.py file for this test, which will define 
 # command and outputs.
 #
-with open(os.path.join(test_source_dir,"run.py")) as f:
-    code = compile(f.read(), "run.py", 'exec')
-    exec (code)
+exec (compile_run_py (os.path.join(test_source_dir,"run.py")))
 
 # Allow a little more slop for slight pixel differences when in DEBUG
 # mode or when running on remote CI machines.
@@ -508,13 +969,41 @@ if (os.getenv('CI') or os.getenv('DEBUG')) :
     failpercent *= 2.0
 
 
+# With OIIO_TESTSUITE_INCREMENTAL=1, skip a test that passed the last time
+# it ran if nothing it depends on has changed and its outputs are still
+# present.
+incremental = int(os.getenv('OIIO_TESTSUITE_INCREMENTAL', '0'))
+if incremental :
+    fingerprint = test_fingerprint (command, outputs)
+    try :
+        with open (testcache_file, 'r') as f :
+            cached = json.load (f)
+    except (OSError, ValueError) :
+        cached = {}
+    if (cached.get("fingerprint") == fingerprint and cached.get("status") == "PASS"
+            and all (os.path.exists(out) for out in outputs)) :
+        print ("PASS: unchanged since the last passing run")
+        sys.exit (0)
+
 # Run the test and check the outputs
-ret = runtest (command, outputs, failureok=failureok)
+ret = runtest (command, outputs, failureok=failureok, parallel=parallel)
+
+if incremental :
+    try :
+        with open (testcache_file, 'w') as f :
+            json.dump ({ "fingerprint" : fingerprint,
+                         "status" : ("PASS" if ret == 0 else "FAIL") }, f)
+    except OSError :
+        pass
 
 if ret == 0 and cleanup_on_success :
-    for ext in image_extensions + [ ".txt", ".diff" ] :
-        for f in glob.iglob (srcdir + '/*' + ext) :
-            os.remove(f)
-            #print('REMOVED ', f)
+    # One pass over the directory, rather than one glob per extension
+    exts = tuple (image_extensions | { ".txt", ".diff" })
+    with os.scandir (srcdir) as entries :
+        for f in entries :
+            if (f.name.lower().endswith (exts) and not f.name.startswith ('.')
+                    and f.is_file (follow_symlinks=False)) :
+                os.remove (f.path)
+                #print('REMOVED ', f.path)
 
 sys.exit (ret)